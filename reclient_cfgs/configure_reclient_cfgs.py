@@ -5,7 +5,11 @@
 """This script is used to fetch reclient cfgs."""
 
 import argparse
-import glob
+import concurrent.futures
+import functools
+import hashlib
+import importlib.util
+import json
 import logging
 import os
 import posixpath
@@ -14,10 +18,20 @@ import shutil
 import string
 import subprocess
 import sys
+import threading
 
 THIS_DIR = os.path.abspath(os.path.dirname(__file__))
 CHROMIUM_SRC = os.path.abspath(os.path.join(THIS_DIR, "..", ".."))
 REPROXY_CFG_PATH = os.path.join(THIS_DIR, "reproxy.cfg")
+REVISION_CACHE_PATH = os.path.join(THIS_DIR, ".revision_cache.json")
+STAMP_PATH = os.path.join(THIS_DIR, ".reclient_cfgs.stamp")
+INSTALLED_REVISIONS_PATH = os.path.join(THIS_DIR,
+                                        ".installed_revisions.json")
+# Serializes updates of REVISION_CACHE_PATH by concurrent revision lookups.
+REVISION_CACHE_LOCK = threading.Lock()
+
+COMMIT_HASH_RE = re.compile(r"^[0-9a-f]{40,}$")
+RBE_INSTANCE_RE = re.compile(r"projects/([-\w]+)/instances/[-\w]+")
 
 REPROXY_CFG_HEADER = """# AUTOGENERATED FILE - DO NOT EDIT
 # Generated by configure_reclient_cfgs.py
@@ -62,13 +76,170 @@ experimental_credentials_helper_args={args}
 )
 
 
+def Which(cmd):
+    """Returns the path of |cmd| so it can be run without a shell.
+
+    On Windows, depot_tools provides git, gclient and cipd as .bat wrappers
+    which CreateProcess only finds by their full path.
+    """
+    return shutil.which(cmd) or cmd
+
+
+def MtimeKey(paths):
+    """Returns the mtimes of |paths|, for use as a revision cache key."""
+    key = []
+    for path in paths:
+        try:
+            key.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            key.append(None)
+    return key
+
+
+def ReadRevisionCache():
+    try:
+        with open(REVISION_CACHE_PATH) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return cache
+
+
+def CachedRevision(toolchain, key, lookup):
+    """Returns the revision of |toolchain|, calling |lookup| on cache miss.
+
+    The revision is cached in REVISION_CACHE_PATH together with |key|, and
+    reused by later invocations as long as |key| is unchanged.
+    """
+    cache = ReadRevisionCache()
+    if key is not None and toolchain in cache:
+        try:
+            cached_key, revision = cache[toolchain]
+        except (TypeError, ValueError):
+            # A malformed entry is a miss; it is overwritten below.
+            cached_key = None
+        if cached_key == key:
+            return revision
+
+    revision = lookup()
+    if key is None or not revision:
+        return revision
+    with REVISION_CACHE_LOCK:
+        # Re-read the cache, as other lookups may have updated it meanwhile.
+        cache = ReadRevisionCache()
+        cache[toolchain] = [key, revision]
+        tmp_path = REVISION_CACHE_PATH + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, REVISION_CACHE_PATH)
+        except OSError as e:
+            logging.warning("failed to write %s: %s", REVISION_CACHE_PATH, e)
+    return revision
+
+
+@functools.cache
 def ClangRevision():
-    sys.path.insert(0, os.path.join(CHROMIUM_SRC, "tools", "clang", "scripts"))
-    import update
-    sys.path.pop(0)
-    return update.PACKAGE_VERSION
+    update_py = os.path.join(CHROMIUM_SRC, "tools", "clang", "scripts",
+                             "update.py")
 
+    def Lookup():
+        # Load update.py by path rather than through sys.path, which is
+        # shared with the other threads.
+        spec = importlib.util.spec_from_file_location("_clang_update",
+                                                      update_py)
+        update = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(update)
+        return update.PACKAGE_VERSION
 
+    return CachedRevision("chromium-browser-clang", MtimeKey([update_py]),
+                          Lookup)
+
+
+def ReadGitHead(git_dir):
+    """Returns the contents of HEAD in |git_dir|, or None if unreadable."""
+    try:
+        with open(os.path.join(git_dir, "HEAD")) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def ReadGitHeadRevision(git_dir):
+    """Returns the commit HEAD in |git_dir| points to, without running git.
+
+    Returns None if the commit cannot be determined from the files alone.
+    """
+    head = ReadGitHead(git_dir)
+    if head and head.startswith("ref: "):
+        ref = head[len("ref: "):]
+        try:
+            with open(os.path.join(git_dir, ref)) as f:
+                head = f.read().strip()
+        except OSError:
+            # The ref may only exist in packed-refs, as "<commit> <ref>".
+            head = None
+            try:
+                with open(os.path.join(git_dir, "packed-refs")) as f:
+                    for line in f:
+                        commit, _, name = line.strip().partition(" ")
+                        if name == ref:
+                            head = commit
+                            break
+            except OSError:
+                return None
+    if head and COMMIT_HASH_RE.match(head):
+        return head
+    return None
+
+
+def NaclGitCacheKey(git_dir):
+    """Returns the revision cache key for the nacl checkout in |git_dir|.
+
+    This covers HEAD, the ref it points to and the remote configuration, so
+    that both new commits and a changed remote invalidate the cache. With the
+    reftable ref format, refs are not stored in these files; instead every
+    ref update replaces reftable/tables.list.
+    """
+    head = ReadGitHead(git_dir)
+    if head is None:
+        return None
+    paths = [
+        os.path.join(git_dir, "HEAD"),
+        os.path.join(git_dir, "packed-refs"),
+        os.path.join(git_dir, "config"),
+        os.path.join(git_dir, "reftable", "tables.list"),
+    ]
+    if head.startswith("ref: "):
+        paths.append(os.path.join(git_dir, head[len("ref: "):]))
+    return MtimeKey(paths)
+
+
+def NaclGitRevision(nacl_dir):
+    remote_host = subprocess.run([Which("git"), "ls-remote", "--get-url"],
+                                 cwd=nacl_dir,
+                                 text=True,
+                                 stdout=subprocess.PIPE).stdout.strip()
+    # check nacl dir is checkout of native_client.
+    if re.match(".*native_client.*", remote_host):
+        revision = ReadGitHeadRevision(os.path.join(nacl_dir, ".git"))
+        if revision:
+            return revision
+        return subprocess.run(
+            [Which("git"), "rev-parse", "HEAD"],
+            cwd=nacl_dir,
+            text=True,
+            check=True,
+            stdout=subprocess.PIPE,
+        ).stdout.strip()
+    logging.warning('unexpected remote host for native_client dir: %s',
+                    remote_host)
+    return None
+
+
+@functools.cache
 def NaclRevision():
     nacl_dir = os.path.join(CHROMIUM_SRC, "native_client")
     # With git submodules, nacl_dir will always exist, regardless if it is
@@ -78,43 +249,26 @@ def NaclRevision():
     if not os.path.exists(os.path.join(nacl_dir, "README.md")):
         return None
 
-    if os.path.isdir(os.path.join(nacl_dir, ".git")):
-        remote_host = subprocess.run(["git", "ls-remote", "--get-url"],
-                                     cwd=nacl_dir,
-                                     shell=os.name == "nt",
-                                     text=True,
-                                     stdout=subprocess.PIPE).stdout.strip()
-        # check nacl dir is checkout of native_client.
-        if re.match(".*native_client.*", remote_host):
-            return subprocess.run(
-                ["git", "log", "-1", "--format=%H"],
-                cwd=nacl_dir,
-                shell=os.name == "nt",
-                text=True,
-                check=True,
-                stdout=subprocess.PIPE,
-            ).stdout.strip()
-        else:
-            logging.warning(
-                'unexpected remote host for native_client dir: %s' %
-                remote_host)
+    git_dir = os.path.join(nacl_dir, ".git")
+    if os.path.isdir(git_dir):
+        revision = CachedRevision("nacl", NaclGitCacheKey(git_dir),
+                                  lambda: NaclGitRevision(nacl_dir))
+        if revision:
+            return revision
 
     # If we're in a work tree without .git directories, we can fallback to
     # the slower method of looking the revision up via `gclient revinfo`.
-    gclient_env = os.environ.copy()
-    gclient_env["DEPOT_TOOLS_UPDATE"] = "0"
     revinfo = subprocess.run(
-        ["gclient", "revinfo", "--filter=src/native_client"],
-        shell=os.name == "nt",
+        [Which("gclient"), "revinfo", "--filter=src/native_client"],
         text=True,
         check=True,
         stdout=subprocess.PIPE,
-        env=gclient_env,
+        env={**os.environ, "DEPOT_TOOLS_UPDATE": "0"},
     ).stdout.strip()
     try:
         # We expect this format: "src/native_client: {url}@{commit}"
         commit = revinfo.split("@")[1]
-        if not re.match("^[0-9a-f]{40,}$", commit):
+        if not COMMIT_HASH_RE.match(commit):
             raise ValueError("invalid commit hash")
         return commit
     except (IndexError, ValueError):
@@ -136,35 +290,99 @@ class CipdAuthError(CipdError):
     """Raised by configure_reclient_cfgs on cipd auth error."""
 
 
-def CipdEnsure(pkg_name, ref, directory, quiet):
-    logging.info("ensure %s %s in %s", pkg_name, ref, directory)
+def CipdEnsure(packages, directory, quiet):
+    """Installs |packages| into |directory| with a single 'cipd ensure'.
+
+    |packages| is a list of (package name, ref, subdir) tuples, where subdir
+    is relative to |directory|.
+    """
     log_level = "warning" if quiet else "info"
-    ensure_file = """
-$ParanoidMode CheckIntegrity
-{pkg} {ref}
-""".format(pkg=pkg_name, ref=ref)
+    ensure_file = "$ParanoidMode CheckIntegrity\n"
+    for pkg_name, ref, subdir in packages:
+        logging.info("ensure %s %s in %s", pkg_name, ref,
+                     os.path.join(directory, subdir))
+        ensure_file += "@Subdir {subdir}\n{pkg} {ref}\n".format(
+            subdir=subdir, pkg=pkg_name, ref=ref)
+    cmd = [
+        Which("cipd"), "ensure", "-log-level=" + log_level, "-root", directory,
+        "-ensure-file", "-"
+    ]
+    output = []
+    # Stream cipd's progress as it comes instead of buffering all of it.
     try:
-        output = subprocess.check_output(
-            " ".join([
-                "cipd", "ensure", "-log-level=" + log_level, "-root",
-                directory, "-ensure-file", "-"
-            ]),
-            shell=True,
-            input=ensure_file,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-        )
-        logging.info(output)
-    except subprocess.CalledProcessError as e:
+        proc = subprocess.Popen(cmd,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                text=True)
+    except OSError as e:
+        raise CipdError("failed to run cipd: %s" % e) from e
+    with proc:
+        try:
+            proc.stdin.write(ensure_file)
+            proc.stdin.close()
+        except BrokenPipeError:
+            # cipd exited without reading the ensure file; its output and
+            # exit status below tell why.
+            pass
+        for line in proc.stdout:
+            logging.info(line.rstrip())
+            output.append(line)
+    if proc.returncode != 0:
+        output = "".join(output)
         if not IsCipdLoggedIn():
-            raise CipdAuthError(e.output) from e
-        raise CipdError(e.output) from e
+            raise CipdAuthError(output)
+        raise CipdError(output)
 
 
+def ReadInstalledRevisions():
+    """Returns the toolchain revisions installed by the last cipd ensure."""
+    try:
+        with open(INSTALLED_REVISIONS_PATH) as f:
+            revisions = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(revisions, dict):
+        return {}
+    return revisions
+
+
+def WriteFileAtomically(path, content):
+    with open(path + ".tmp", "w") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+
+
+def RemoveStaleCipdRoots(toolchains):
+    """Removes toolchain directories that are still cipd roots of their own.
+
+    Each toolchain directory used to be a cipd root, holding a full copy of
+    its package. They are now all installed by one root in THIS_DIR, which
+    does not track the files the old roots deployed, so remove such a
+    directory entirely and let the new root install it from scratch.
+    """
+
+    def OnError(func, path, _):
+        # cipd installs files read-only, which Windows refuses to delete.
+        os.chmod(path, 0o777)
+        func(path)
+
+    for toolchain in toolchains:
+        toolchain_root = os.path.join(THIS_DIR, toolchain)
+        if os.path.isdir(os.path.join(toolchain_root, ".cipd")):
+            logging.info("remove stale cipd root %s", toolchain_root)
+            shutil.rmtree(toolchain_root, onerror=OnError)
+
+
+@functools.cache
 def IsCipdLoggedIn():
-    ps = subprocess.run(
-        ' '.join(['cipd', 'auth-info']),
-        shell=True, capture_output=True, text=True)
+    try:
+        ps = subprocess.run([Which('cipd'), 'auth-info'],
+                            capture_output=True,
+                            text=True)
+    except OSError as e:
+        logging.warning("failed to run cipd auth-info: %s", e)
+        return False
     logging.warning(
         "log for http://b/304677840: stdout from cipd auth-info: %s",
         ps.stdout)
@@ -175,7 +393,7 @@ def IsCipdLoggedIn():
 
 
 def RbeProjectFromInstance(instance):
-    m = re.fullmatch(r"projects/([-\w]+)/instances/[-\w]+", instance)
+    m = RBE_INSTANCE_RE.fullmatch(instance)
     if not m:
         return None
     return m.group(1)
@@ -186,11 +404,13 @@ def GenerateReproxyCfg(reproxy_cfg_template, rbe_instance, rbe_project,
     tmpl_path = os.path.join(THIS_DIR, "reproxy_cfg_templates",
                              reproxy_cfg_template)
     logging.info(f"generate reproxy.cfg using {tmpl_path}")
-    if not os.path.isfile(tmpl_path):
+    try:
+        with open(tmpl_path) as f:
+            reproxy_cfg_tmpl = string.Template(f.read())
+    except OSError:
+        # Also covers |tmpl_path| naming a directory.
         logging.warning(f"{tmpl_path} does not exist")
         return False
-    with open(tmpl_path) as f:
-        reproxy_cfg_tmpl = string.Template(REPROXY_CFG_HEADER + f.read())
     depsscanner_address = "exec://" + os.path.join(
         CHROMIUM_SRC, "buildtools", "reclient", "scandeps_server")
     auth_flags = AUTO_AUTH_FLAGS
@@ -202,14 +422,19 @@ def GenerateReproxyCfg(reproxy_cfg_template, rbe_instance, rbe_project,
     if use_luci_auth:
         auth_flags = LUCI_AUTH_CREDSHELPER_FLAGS
 
-    reproxy_cfg = reproxy_cfg_tmpl.substitute({
+    mapping = {
         "rbe_instance": rbe_instance,
         "rbe_project": rbe_project,
         "reproxy_cfg_template": reproxy_cfg_template,
         "depsscanner_address": depsscanner_address,
         "auth_flags": auth_flags,
-    })
+    }
+    # Substitute before opening reproxy.cfg, so that a bad template leaves
+    # the existing file alone.
+    header = string.Template(REPROXY_CFG_HEADER).substitute(mapping)
+    reproxy_cfg = reproxy_cfg_tmpl.substitute(mapping)
     with open(REPROXY_CFG_PATH, "w") as f:
+        f.write(header)
         f.write(reproxy_cfg)
     return True
 
@@ -247,6 +472,50 @@ def ReadConfig():
         return entries
 
 
+def CopyWinCrossCfgs(toolchain):
+    """Copies the win-cross cfgs of |toolchain| into win-cross/|toolchain|."""
+    toolchain_root = os.path.join(THIS_DIR, toolchain)
+    win_cross_cfg_dir = "win-cross"
+    wcedir = os.path.join(THIS_DIR, win_cross_cfg_dir, toolchain)
+    os.makedirs(wcedir, mode=0o755, exist_ok=True)
+    try:
+        entries = os.scandir(os.path.join(toolchain_root, win_cross_cfg_dir))
+    except FileNotFoundError:
+        return
+    # copy in win-cross/toolchain
+    # as windows may not use symlinks.
+    with entries:
+        for entry in entries:
+            if not entry.name.endswith(".cfg") or not entry.is_file():
+                continue
+            fname = os.path.join(wcedir, entry.name)
+            src_st = entry.stat()
+            try:
+                dst_st = os.stat(fname)
+            except FileNotFoundError:
+                dst_st = None
+            # Copies get the mtime of their source, so an unchanged cfg
+            # from a previous run can be skipped.
+            if (dst_st and dst_st.st_size == src_st.st_size
+                    and dst_st.st_mtime_ns == src_st.st_mtime_ns):
+                continue
+            logging.info("Copy from %s to %s...", entry.path, fname)
+            # Copy next to the destination and rename over it, which
+            # replaces an existing file in a single step.
+            # The mode of the read-only cipd file is not copied, so that
+            # the copy can be replaced later.
+            tmp_fname = fname + ".tmp"
+            shutil.copyfile(entry.path, tmp_fname)
+            os.utime(tmp_fname, ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
+            try:
+                os.replace(tmp_fname, fname)
+            except PermissionError:
+                # Windows refuses to replace read-only files, which copies
+                # made by older versions of this script are.
+                os.chmod(fname, 0o777)
+                os.replace(tmp_fname, fname)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="configure reclient cfgs",
@@ -332,52 +601,89 @@ def main():
     if args.skip_remoteexec_cfg_fetch:
         return 0
 
-    logging.info("fetch reclient_cfgs for RBE project %s..." % rbe_project)
+    logging.info("fetch reclient_cfgs for RBE project %s...", rbe_project)
 
     cipd_prefix = posixpath.join(args.cipd_prefix, rbe_project)
 
-    tool_revisions = {
-        "chromium-browser-clang": ClangRevision(),
-        "nacl": NaclRevision(),
-        "python": "3.8.0",
-    }
-    for toolchain in tool_revisions:
-        revision = tool_revisions[toolchain]
-        if not revision:
-            logging.info("failed to detect %s revision" % toolchain)
-            continue
+    # The revisions are looked up independently of each other, and looking
+    # them up may run git or gclient, so do it concurrently.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        clang_revision = executor.submit(ClangRevision)
+        nacl_revision = executor.submit(NaclRevision)
+        tool_revisions = {
+            "chromium-browser-clang": clang_revision.result(),
+            "nacl": nacl_revision.result(),
+            "python": "3.8.0",
+        }
+    fetches = [(toolchain, revision)
+               for toolchain, revision in tool_revisions.items() if revision]
+    undetected = [
+        toolchain for toolchain, revision in tool_revisions.items()
+        if not revision
+    ]
+    if undetected:
+        logging.info("failed to detect %s revision", ", ".join(undetected))
+    # All toolchains share one cipd root, and 'cipd ensure' uninstalls the
+    # packages missing from the ensure file. Keep what is installed for
+    # toolchains whose revision could not be detected this time.
+    installed_revisions = ReadInstalledRevisions()
+    for toolchain in undetected:
+        revision = installed_revisions.get(toolchain)
+        if revision and isinstance(revision, str):
+            logging.info("keep installed %s revision %s", toolchain,
+                         revision)
+            fetches.append((toolchain, revision))
+
+    # Skip cipd entirely if the cfgs were already fetched for the same inputs.
+    stamp = hashlib.sha256(
+        json.dumps(
+            {
+                "rev": tool_revisions,
+                "prefix": cipd_prefix,
+                "project": rbe_project,
+            },
+            sort_keys=True,
+        ).encode()).hexdigest()
+    try:
+        with open(STAMP_PATH) as f:
+            up_to_date = f.read() == stamp
+    except OSError:
+        up_to_date = False
+    if up_to_date and all(
+            os.path.isdir(os.path.join(THIS_DIR, toolchain))
+            and os.path.isdir(os.path.join(THIS_DIR, "win-cross", toolchain))
+            for toolchain, _ in fetches):
+        logging.info("reclient cfgs are up to date")
+        return 0
+    # Drop the stamp while updating, so a failed update is retried.
+    try:
+        os.remove(STAMP_PATH)
+    except FileNotFoundError:
+        pass
 
-        toolchain_root = os.path.join(THIS_DIR, toolchain)
-        cipd_ref = "revision/" + revision
-        # 'cipd ensure' initializes the directory.
-        try:
-            CipdEnsure(
-                posixpath.join(cipd_prefix, toolchain),
-                ref=cipd_ref,
-                directory=toolchain_root,
-                quiet=args.quiet,
-            )
-        except CipdAuthError as e:
-            RequestCipdAuthentication()
-            return 1
-        except CipdError as e:
-            logging.error(e)
-            return 1
-        win_cross_cfg_dir = "win-cross"
-        wcedir = os.path.join(THIS_DIR, win_cross_cfg_dir, toolchain)
-        if not os.path.exists(wcedir):
-            os.makedirs(wcedir, mode=0o755)
-        if os.path.exists(os.path.join(toolchain_root, win_cross_cfg_dir)):
-            # copy in win-cross/toolchain
-            # as windows may not use symlinks.
-            for cfg in glob.glob(
-                    os.path.join(toolchain_root, win_cross_cfg_dir, "*.cfg")):
-                fname = os.path.join(wcedir, os.path.basename(cfg))
-                if os.path.exists(fname):
-                    os.chmod(fname, 0o777)
-                    os.remove(fname)
-                logging.info("Copy from %s to %s..." % (cfg, fname))
-                shutil.copy(cfg, fname)
+    RemoveStaleCipdRoots(tool_revisions)
+
+    # 'cipd ensure' initializes the toolchain directories. All of them are
+    # installed by one cipd invocation, each into its own subdirectory.
+    try:
+        CipdEnsure(
+            [(posixpath.join(cipd_prefix, toolchain), "revision/" + revision,
+              toolchain) for toolchain, revision in fetches],
+            directory=THIS_DIR,
+            quiet=args.quiet,
+        )
+    except CipdAuthError as e:
+        RequestCipdAuthentication()
+        # Make a later check query 'cipd auth-info' again.
+        IsCipdLoggedIn.cache_clear()
+        return 1
+    except CipdError as e:
+        logging.error(e)
+        return 1
+    WriteFileAtomically(INSTALLED_REVISIONS_PATH, json.dumps(dict(fetches)))
+    for toolchain, _ in fetches:
+        CopyWinCrossCfgs(toolchain)
+    WriteFileAtomically(STAMP_PATH, stamp)
     return 0
 
 
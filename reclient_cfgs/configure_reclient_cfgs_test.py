@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+# Copyright 2026 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Tests for configure_reclient_cfgs."""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import configure_reclient_cfgs
+
+
+def Git(repo_dir, *args):
+    return subprocess.run(
+        [
+            "git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+            *args
+        ],
+        cwd=repo_dir,
+        text=True,
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout.strip()
+
+
+# Records the ensure file passed to 'cipd ensure' and prints some progress.
+STUB_CIPD = """#!{python}
+import os
+import sys
+
+if sys.argv[1] == "auth-info":
+    sys.exit(0)
+if os.environ.get("STUB_CIPD_EXIT"):
+    print("cipd: exiting early")
+    sys.exit(int(os.environ["STUB_CIPD_EXIT"]))
+ensure_file = sys.stdin.read()
+with open(os.environ["STUB_CIPD_ENSURE_FILE"], "w") as f:
+    f.write(ensure_file)
+print("installing 1")
+print("installing 2")
+"""
+
+
+class StubCipdTestCase(unittest.TestCase):
+    """Puts a stub cipd, and nothing else, on PATH."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.bin_dir = os.path.join(self.temp_dir, "bin")
+        os.mkdir(self.bin_dir)
+        cipd = os.path.join(self.bin_dir, "cipd")
+        with open(cipd, "w") as f:
+            f.write(STUB_CIPD.format(python=sys.executable))
+        os.chmod(cipd, 0o755)
+        self.ensure_file_path = os.path.join(self.temp_dir, "ensure_file")
+        patcher = mock.patch.dict(
+            os.environ, {
+                "PATH": self.bin_dir,
+                "STUB_CIPD_ENSURE_FILE": self.ensure_file_path,
+            })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        configure_reclient_cfgs.IsCipdLoggedIn.cache_clear()
+        self.addCleanup(configure_reclient_cfgs.IsCipdLoggedIn.cache_clear)
+
+    def ReadEnsureFile(self):
+        with open(self.ensure_file_path) as f:
+            return f.read()
+
+
+@unittest.skipIf(sys.platform == "win32", "stub cipd is a POSIX script")
+class CipdEnsureTest(StubCipdTestCase):
+
+    def testSuccessStreamsOutput(self):
+        with self.assertLogs(level="INFO") as logs:
+            configure_reclient_cfgs.CipdEnsure(
+                [("prefix/nacl", "revision/abc", "nacl")],
+                directory=self.temp_dir,
+                quiet=True)
+        self.assertIn("INFO:root:installing 1", logs.output)
+        self.assertIn("INFO:root:installing 2", logs.output)
+        self.assertEqual(
+            "$ParanoidMode CheckIntegrity\n"
+            "@Subdir nacl\n"
+            "prefix/nacl revision/abc\n", self.ReadEnsureFile())
+
+    def testMissingBinary(self):
+        os.remove(os.path.join(self.bin_dir, "cipd"))
+        with self.assertRaises(configure_reclient_cfgs.CipdError):
+            configure_reclient_cfgs.CipdEnsure(
+                [("prefix/nacl", "revision/abc", "nacl")],
+                directory=self.temp_dir,
+                quiet=True)
+
+    def testEarlyExit(self):
+        os.environ["STUB_CIPD_EXIT"] = "3"
+        # Larger than a pipe buffer, so writing it fails once cipd exited.
+        ref = "revision/" + "a" * (1 << 20)
+        with self.assertRaises(configure_reclient_cfgs.CipdError) as cm:
+            configure_reclient_cfgs.CipdEnsure([("prefix/nacl", ref, "nacl")],
+                                               directory=self.temp_dir,
+                                               quiet=True)
+        self.assertNotIsInstance(cm.exception,
+                                 configure_reclient_cfgs.CipdAuthError)
+        self.assertEqual("cipd: exiting early\n", str(cm.exception))
+
+
+def PatchThisDir(test, this_dir):
+    """Points THIS_DIR and the state files derived from it at |this_dir|."""
+    for name, value in (
+        ("THIS_DIR", this_dir),
+        ("STAMP_PATH", os.path.join(this_dir, ".reclient_cfgs.stamp")),
+        ("INSTALLED_REVISIONS_PATH",
+         os.path.join(this_dir, ".installed_revisions.json")),
+    ):
+        patcher = mock.patch.object(configure_reclient_cfgs, name, value)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
+def RunMain(clang_revision, nacl_revision, cipd_prefix="prefix"):
+    with mock.patch.object(configure_reclient_cfgs,
+                           "ClangRevision",
+                           return_value=clang_revision), \
+         mock.patch.object(configure_reclient_cfgs,
+                           "NaclRevision",
+                           return_value=nacl_revision), \
+         mock.patch.object(sys, "argv", [
+             "configure_reclient_cfgs.py",
+             "--rbe_instance=projects/project/instances/default",
+             "--cipd_prefix=" + cipd_prefix,
+             "--quiet",
+         ]):
+        return configure_reclient_cfgs.main()
+
+
+@unittest.skipIf(sys.platform == "win32", "stub cipd is a POSIX script")
+class MainEnsureFileTest(StubCipdTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.this_dir = os.path.join(self.temp_dir, "reclient_cfgs")
+        os.mkdir(self.this_dir)
+        PatchThisDir(self, self.this_dir)
+
+    def testEnsureFileListsDetectedToolchains(self):
+        self.assertEqual(0, RunMain("clang-rev", None))
+        self.assertEqual(
+            "$ParanoidMode CheckIntegrity\n"
+            "@Subdir chromium-browser-clang\n"
+            "prefix/project/chromium-browser-clang revision/clang-rev\n"
+            "@Subdir python\n"
+            "prefix/project/python revision/3.8.0\n", self.ReadEnsureFile())
+
+    def testUndetectedToolchainKeepsInstalledRevision(self):
+        self.assertEqual(0, RunMain("clang-rev", "nacl-rev"))
+        self.assertIn("@Subdir nacl\nprefix/project/nacl revision/nacl-rev\n",
+                      self.ReadEnsureFile())
+        self.assertEqual(0, RunMain("clang-rev2", None))
+        ensure_file = self.ReadEnsureFile()
+        self.assertIn("prefix/project/chromium-browser-clang "
+                      "revision/clang-rev2\n", ensure_file)
+        self.assertIn("@Subdir nacl\nprefix/project/nacl revision/nacl-rev\n",
+                      ensure_file)
+
+
+class MainStampTest(unittest.TestCase):
+
+    def setUp(self):
+        self.this_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.this_dir)
+        PatchThisDir(self, self.this_dir)
+        patcher = mock.patch.object(configure_reclient_cfgs,
+                                    "CipdEnsure",
+                                    side_effect=self.CipdEnsure)
+        self.cipd_ensure = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def CipdEnsure(self, packages, directory, quiet):
+        for _, _, subdir in packages:
+            os.makedirs(os.path.join(directory, subdir), exist_ok=True)
+
+    def StampExists(self):
+        return os.path.exists(os.path.join(self.this_dir,
+                                           ".reclient_cfgs.stamp"))
+
+    def testSameInputsSkipCipd(self):
+        self.assertEqual(0, RunMain("clang-rev", "nacl-rev"))
+        self.assertTrue(self.StampExists())
+        self.assertEqual(0, RunMain("clang-rev", "nacl-rev"))
+        self.assertEqual(1, self.cipd_ensure.call_count)
+
+    def testChangedRevisionRunsCipd(self):
+        self.assertEqual(0, RunMain("clang-rev", "nacl-rev"))
+        self.assertEqual(0, RunMain("clang-rev2", "nacl-rev"))
+        self.assertEqual(2, self.cipd_ensure.call_count)
+
+    def testChangedPrefixRunsCipd(self):
+        self.assertEqual(0, RunMain("clang-rev", "nacl-rev"))
+        self.assertEqual(0,
+                         RunMain("clang-rev", "nacl-rev", cipd_prefix="other"))
+        self.assertEqual(2, self.cipd_ensure.call_count)
+
+    def testDeletedToolchainDirRunsCipd(self):
+        self.assertEqual(0, RunMain("clang-rev", "nacl-rev"))
+        shutil.rmtree(os.path.join(self.this_dir, "nacl"))
+        self.assertEqual(0, RunMain("clang-rev", "nacl-rev"))
+        self.assertEqual(2, self.cipd_ensure.call_count)
+
+    def testFailedEnsureLeavesNoStamp(self):
+        self.assertEqual(0, RunMain("clang-rev", "nacl-rev"))
+        self.assertTrue(self.StampExists())
+        self.cipd_ensure.side_effect = configure_reclient_cfgs.CipdError(
+            "cipd ensure failed")
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(1, RunMain("clang-rev2", "nacl-rev"))
+        self.assertFalse(self.StampExists())
+        self.cipd_ensure.side_effect = self.CipdEnsure
+        self.assertEqual(0, RunMain("clang-rev2", "nacl-rev"))
+        self.assertEqual(3, self.cipd_ensure.call_count)
+        self.assertTrue(self.StampExists())
+
+
+class GenerateReproxyCfgTest(unittest.TestCase):
+
+    def setUp(self):
+        self.this_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.this_dir)
+        self.reproxy_cfg = os.path.join(self.this_dir, "reproxy.cfg")
+        for name, value in (("THIS_DIR", self.this_dir), ("REPROXY_CFG_PATH",
+                                                          self.reproxy_cfg)):
+            patcher = mock.patch.object(configure_reclient_cfgs, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        os.mkdir(os.path.join(self.this_dir, "reproxy_cfg_templates"))
+
+    def WriteTemplate(self, content):
+        with open(
+                os.path.join(self.this_dir, "reproxy_cfg_templates",
+                             "test.template"), "w") as f:
+            f.write(content)
+
+    def ReadReproxyCfg(self):
+        with open(self.reproxy_cfg) as f:
+            return f.read()
+
+    def GenerateReproxyCfg(self):
+        return configure_reclient_cfgs.GenerateReproxyCfg(
+            "test.template", "projects/p/instances/i", "p", False)
+
+    def testGenerate(self):
+        self.WriteTemplate("instance=$rbe_instance\n")
+        self.assertTrue(self.GenerateReproxyCfg())
+        reproxy_cfg = self.ReadReproxyCfg()
+        self.assertTrue(
+            reproxy_cfg.startswith("# AUTOGENERATED FILE - DO NOT EDIT\n"))
+        self.assertIn("# Update reproxy_cfg_templates/test.template\n",
+                      reproxy_cfg)
+        self.assertTrue(
+            reproxy_cfg.endswith("\ninstance=projects/p/instances/i\n"))
+
+    def testBadTemplateKeepsExistingFile(self):
+        with open(self.reproxy_cfg, "w") as f:
+            f.write("instance=old\n")
+        self.WriteTemplate("instance=$unknown\n")
+        with self.assertRaises(KeyError):
+            self.GenerateReproxyCfg()
+        self.assertEqual("instance=old\n", self.ReadReproxyCfg())
+
+
+class RemoveStaleCipdRootsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.this_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.this_dir)
+        patcher = mock.patch.object(configure_reclient_cfgs, "THIS_DIR",
+                                    self.this_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testRemovesToolchainDirWithNestedRoot(self):
+        os.makedirs(os.path.join(self.this_dir, "nacl", ".cipd", "pkgs"))
+        os.makedirs(os.path.join(self.this_dir, "nacl", "win-cross"))
+        stale_cfg = os.path.join(self.this_dir, "nacl", "win-cross", "a.cfg")
+        with open(stale_cfg, "w") as f:
+            f.write("stale")
+        os.chmod(stale_cfg, 0o444)
+        configure_reclient_cfgs.RemoveStaleCipdRoots(["nacl"])
+        self.assertFalse(os.path.exists(os.path.join(self.this_dir, "nacl")))
+
+    def testKeepsToolchainDirWithoutNestedRoot(self):
+        cfg = os.path.join(self.this_dir, "nacl", "win-cross", "a.cfg")
+        os.makedirs(os.path.dirname(cfg))
+        with open(cfg, "w") as f:
+            f.write("current")
+        configure_reclient_cfgs.RemoveStaleCipdRoots(["nacl", "python"])
+        self.assertTrue(os.path.isfile(cfg))
+
+
+class GitRevisionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repo_dir)
+        self.git_dir = os.path.join(self.repo_dir, ".git")
+        Git(self.repo_dir, "init", "-q", "-b", "main")
+        self.Commit()
+
+    def Commit(self):
+        Git(self.repo_dir, "commit", "-q", "--allow-empty", "-m", "test")
+        return Git(self.repo_dir, "rev-parse", "HEAD")
+
+    def testReadGitHeadRevisionLooseRef(self):
+        commit = self.Commit()
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.git_dir, "refs", "heads",
+                                        "main")))
+        self.assertEqual(
+            commit, configure_reclient_cfgs.ReadGitHeadRevision(self.git_dir))
+
+    def testReadGitHeadRevisionPackedRefs(self):
+        commit = self.Commit()
+        Git(self.repo_dir, "pack-refs", "--all")
+        self.assertFalse(
+            os.path.exists(os.path.join(self.git_dir, "refs", "heads",
+                                        "main")))
+        self.assertEqual(
+            commit, configure_reclient_cfgs.ReadGitHeadRevision(self.git_dir))
+
+    def testReadGitHeadRevisionDetachedHead(self):
+        commit = self.Commit()
+        Git(self.repo_dir, "checkout", "-q", "--detach")
+        self.assertEqual(
+            commit, configure_reclient_cfgs.ReadGitHeadRevision(self.git_dir))
+
+    def testReadGitHeadRevisionUnresolvable(self):
+        with open(os.path.join(self.git_dir, "HEAD"), "w") as f:
+            f.write("ref: refs/heads/.invalid\n")
+        self.assertIsNone(
+            configure_reclient_cfgs.ReadGitHeadRevision(self.git_dir))
+        self.assertIsNone(
+            configure_reclient_cfgs.ReadGitHeadRevision(
+                os.path.join(self.repo_dir, "missing")))
+
+    def testNaclGitCacheKeyChangesOnCommit(self):
+        key = configure_reclient_cfgs.NaclGitCacheKey(self.git_dir)
+        self.assertEqual(key,
+                         configure_reclient_cfgs.NaclGitCacheKey(self.git_dir))
+        ref_path = os.path.join(self.git_dir, "refs", "heads", "main")
+        st = os.stat(ref_path)
+        self.Commit()
+        os.utime(ref_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        self.assertNotEqual(
+            key, configure_reclient_cfgs.NaclGitCacheKey(self.git_dir))
+
+    def testNaclGitCacheKeyReftable(self):
+        # Repositories using reftable only update reftable/tables.list when
+        # refs move.
+        tables_list = os.path.join(self.git_dir, "reftable", "tables.list")
+        os.makedirs(os.path.dirname(tables_list))
+        with open(tables_list, "w") as f:
+            f.write("0x000000000001-0x000000000001-00000000.ref\n")
+        key = configure_reclient_cfgs.NaclGitCacheKey(self.git_dir)
+        st = os.stat(tables_list)
+        os.utime(tables_list, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        self.assertNotEqual(
+            key, configure_reclient_cfgs.NaclGitCacheKey(self.git_dir))
+
+
+class CachedRevisionTest(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        patcher = mock.patch.object(configure_reclient_cfgs,
+                                    "REVISION_CACHE_PATH",
+                                    os.path.join(temp_dir, "cache.json"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.lookups = []
+
+    def Lookup(self, revision):
+        self.lookups.append(revision)
+        return revision
+
+    def CachedRevision(self, key, revision):
+        return configure_reclient_cfgs.CachedRevision(
+            "nacl", key, lambda: self.Lookup(revision))
+
+    def testHit(self):
+        self.assertEqual("rev1", self.CachedRevision([1], "rev1"))
+        self.assertEqual("rev1", self.CachedRevision([1], "rev2"))
+        self.assertEqual(["rev1"], self.lookups)
+
+    def testKeyChangeInvalidates(self):
+        self.assertEqual("rev1", self.CachedRevision([1], "rev1"))
+        self.assertEqual("rev2", self.CachedRevision([2], "rev2"))
+        self.assertEqual("rev2", self.CachedRevision([2], "rev3"))
+        self.assertEqual(["rev1", "rev2"], self.lookups)
+
+    def testNoKeyIsNotCached(self):
+        self.assertEqual("rev1", self.CachedRevision(None, "rev1"))
+        self.assertEqual("rev2", self.CachedRevision(None, "rev2"))
+        self.assertEqual(["rev1", "rev2"], self.lookups)
+
+    def testFailedLookupIsNotCached(self):
+        self.assertIsNone(self.CachedRevision([1], None))
+        self.assertEqual("rev1", self.CachedRevision([1], "rev1"))
+        self.assertEqual([None, "rev1"], self.lookups)
+
+    def WriteCache(self, cache):
+        with open(configure_reclient_cfgs.REVISION_CACHE_PATH, "w") as f:
+            json.dump(cache, f)
+
+    def testMalformedCacheIsIgnored(self):
+        for cache in ([["nacl", [1]]], {"nacl": "rev0"}, {"nacl": [[1]]},
+                      {"nacl": None}):
+            self.WriteCache(cache)
+            self.assertEqual("rev1", self.CachedRevision([1], "rev1"))
+            # The cache was rewritten, so the next lookup hits.
+            self.assertEqual("rev1", self.CachedRevision([1], "rev2"))
+        self.assertEqual(["rev1"] * 4, self.lookups)
+
+    def testOtherToolchainsAreKept(self):
+        configure_reclient_cfgs.CachedRevision("chromium-browser-clang", [1],
+                                               lambda: "clang")
+        self.CachedRevision([1], "rev1")
+        self.assertEqual(
+            "clang",
+            configure_reclient_cfgs.CachedRevision("chromium-browser-clang",
+                                                   [1], lambda: "other"))
+
+
+class CopyWinCrossCfgsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.this_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.this_dir)
+        patcher = mock.patch.object(configure_reclient_cfgs, "THIS_DIR",
+                                    self.this_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.src = os.path.join(self.this_dir, "nacl", "win-cross", "a.cfg")
+        self.dst = os.path.join(self.this_dir, "win-cross", "nacl", "a.cfg")
+        os.makedirs(os.path.dirname(self.src))
+        self.WriteSource("old")
+
+    def WriteSource(self, content):
+        with open(self.src, "w") as f:
+            f.write(content)
+
+    def ReadDestination(self):
+        with open(self.dst) as f:
+            return f.read()
+
+    def CopyWinCrossCfgs(self):
+        with mock.patch.object(configure_reclient_cfgs.shutil,
+                               "copyfile",
+                               wraps=shutil.copyfile) as copyfile:
+            configure_reclient_cfgs.CopyWinCrossCfgs("nacl")
+        return copyfile.call_count
+
+    def testUnchangedCfgIsSkipped(self):
+        self.assertEqual(1, self.CopyWinCrossCfgs())
+        self.assertEqual("old", self.ReadDestination())
+        self.assertEqual(
+            os.stat(self.src).st_mtime_ns,
+            os.stat(self.dst).st_mtime_ns)
+        self.assertEqual(0, self.CopyWinCrossCfgs())
+        self.assertEqual("old", self.ReadDestination())
+
+    def testChangedCfgIsCopied(self):
+        self.assertEqual(1, self.CopyWinCrossCfgs())
+        self.WriteSource("newer")
+        self.assertEqual(1, self.CopyWinCrossCfgs())
+        self.assertEqual("newer", self.ReadDestination())
+
+    def testChangedCfgWithSameSizeIsCopied(self):
+        self.assertEqual(1, self.CopyWinCrossCfgs())
+        self.WriteSource("new")
+        st = os.stat(self.src)
+        os.utime(self.src, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        self.assertEqual(1, self.CopyWinCrossCfgs())
+        self.assertEqual("new", self.ReadDestination())
+
+
+if __name__ == "__main__":
+    unittest.main()